@@ -2,32 +2,16 @@
 # تطبيق Streamlit لاستخراج أرقام الموبايل وبناء روابط واتساب برسالة عربية جاهزة
 # -------------------------------------------------------------
 
-from typing import Optional, List
+from typing import Literal, List, Tuple
+import argparse
+import importlib.util
 import re
 from io import BytesIO
 from urllib.parse import quote
+import numpy as np
 import pandas as pd
 import streamlit as st
 
-# -----------------------------
-# تهيئة الصفحة + RTL
-# -----------------------------
-st.set_page_config(
-    page_title="مُولِّد روابط واتساب للأوردرات",
-    page_icon="🟢",
-    layout="wide",
-)
-
-st.markdown("""
-<style>
-html, body, [class*="css"]  { direction: rtl; text-align: right; }
-[data-testid="stMetricValue"] { direction:ltr; }
-</style>
-""", unsafe_allow_html=True)
-
-st.title("🟢 مُولِّد روابط واتساب للأوردرات")
-st.caption("حمّل ملف الإكسل، وسيتم استخراج الأرقام وبناء الكميات ودمجها في رسالة عربية جاهزة داخل رابط واتساب.")
-
 # -----------------------------
 # ثوابت الأعمدة حسب المخطط
 # -----------------------------
@@ -46,192 +30,303 @@ AR_TEMPLATE_FIXED = (
     "\nالاجمالي: {total}"
 )
 
+# تقسيم القالب مرة واحدة عند التحميل بدل str.format لكل صف
+_TPL_PREFIX, _TPL_REST = AR_TEMPLATE_FIXED.split("{quantity}")
+_TPL_MIDDLE, _TPL_SUFFIX = _TPL_REST.split("{total}")
+
+WA_BASE_URL = "https://wa.me/"
+
 # -----------------------------
 # دوال استخراج وتحويل الأرقام
 # -----------------------------
 EG_MOBILE_REGEX = re.compile(r'(?:\+?20)?0?1\d{9}')  # يقبل +20/20/01
-
-def normalize_eg_phone(text: str) -> Optional[str]:
-    """يحول رقم مصري لصيغة 201XXXXXXXXX"""
-    if text is None:
-        return None
-    s = str(text)
-    m = EG_MOBILE_REGEX.search(s)
-    if not m:
-        return None
-    digits = re.sub(r"\D", "", m.group())
-
-    # تحويل للصيغة الدولية
-    if digits.startswith("0") and len(digits) == 11:
-        digits = "20" + digits[1:]
-    elif digits.startswith("20") and len(digits) == 12:
-        pass
-    elif digits.startswith("1") and len(digits) == 10:
-        digits = "20" + digits
-    else:
-        return None
-
-    if not (digits.startswith("201") and len(digits) == 12):
-        return None
-    return digits
-
-def extract_first_phone_from_row(row: pd.Series) -> Optional[str]:
-    """يستخرج أول رقم مصري صالح من الصف"""
-    for val in row:
-        digits = normalize_eg_phone(val)
-        if digits:
-            return digits
-    return None
+EG_MOBILE_GROUP_REGEX = re.compile(f"({EG_MOBILE_REGEX.pattern})")  # نفس النمط كمجموعة لـ str.extract
+# جدول str.translate يحذف كل ما ليس رقمًا (المطابقة لا تحوي إلا "+" وأرقامًا)
+_KEEP_DIGITS = str.maketrans("", "", "".join(chr(c) for c in range(256) if not chr(c).isdecimal()))
+
+# تحويل للصيغة الدولية حسب عدد الأرقام: الطول -> (البادئة المطلوبة، ما يُحذف قبل إضافة 20)
+_NORMALIZERS = {
+    11: ("0", "0"),    # 01XXXXXXXXX
+    12: ("20", "20"),  # 201XXXXXXXXX
+    10: ("1", ""),     # 1XXXXXXXXX
+}
+
+def normalize_eg_phones(matches: pd.Series) -> pd.Series:
+    """يحول عمودًا كاملًا من المطابقات لصيغة 201XXXXXXXXX (NaN لغير الصالح)"""
+    digits = matches.fillna("").str.translate(_KEEP_DIGITS)
+    length = digits.str.len()
+
+    # تحويل للصيغة الدولية (نفس قواعد _NORMALIZERS)
+    conditions, choices = [], []
+    for n_digits, (prefix, drop) in _NORMALIZERS.items():
+        conditions.append(digits.str.startswith(prefix) & (length == n_digits))
+        choices.append(("20" + digits.str[len(drop):]).to_numpy(dtype=object))
+    normalized = pd.Series(np.select(conditions, choices, default=None), index=matches.index, dtype=object)
+
+    valid = normalized.str.startswith("201", na=False) & normalized.str.len().eq(12)
+    return normalized.where(valid)
+
+PHONE_SAMPLE_ROWS = 50   # عدد الصفوف الأولى المستخدمة لتحديد عمود الهاتف
+PHONE_COL_SHARE = 0.8    # نسبة الأرقام التي يجب أن تأتي من عمود واحد لاعتباره عمود الهاتف
+
+def _first_phone_by_column(df: pd.DataFrame, col_order: List[int]) -> Tuple[pd.Series, pd.Series]:
+    """يمر على الأعمدة بالترتيب المعطى ويعيد أول رقم صالح لكل صف ورقم العمود الذي جاء منه (-1 إن لم يوجد)"""
+    phones = pd.Series(None, index=df.index, dtype=object)
+    source = pd.Series(-1, index=df.index)
+    for idx in col_order:
+        missing = phones.isna()
+        if not missing.any():
+            break
+        matches = df.iloc[:, idx][missing].str.extract(EG_MOBILE_GROUP_REGEX, expand=False)
+        phones[missing] = normalize_eg_phones(matches)
+        source[missing & phones.notna()] = idx
+    return phones, source
+
+def extract_first_phone_per_row(df: pd.DataFrame) -> pd.Series:
+    """يستخرج أول رقم مصري صالح من كل صف دفعة واحدة (عمودًا بعمود بدل خلية بخلية)"""
+    all_cols = list(range(df.shape[1]))
+    if len(df) <= PHONE_SAMPLE_ROWS:
+        return _first_phone_by_column(df, all_cols)[0]
+
+    # تحديد عمود الهاتف من أول الصفوف، ثم البدء به لباقي الصفوف
+    head, rest = df.iloc[:PHONE_SAMPLE_ROWS], df.iloc[PHONE_SAMPLE_ROWS:]
+    head_phones, source = _first_phone_by_column(head, all_cols)
+    hits = source[source >= 0].value_counts()
+    col_order = all_cols
+    if not hits.empty and hits.iloc[0] > PHONE_COL_SHARE * hits.sum():
+        phone_col = int(hits.index[0])
+        # الصفوف التي لا يوجد بها رقم في هذا العمود تُفحص بباقي الأعمدة
+        col_order = [phone_col] + [idx for idx in all_cols if idx != phone_col]
+    rest_phones = _first_phone_by_column(rest, col_order)[0]
+    return pd.concat([head_phones, rest_phones])
 
 def encode_for_whatsapp(text: str) -> str:
     return quote(text, safe="")
 
-def build_wa_link(phone_digits: str, message: str) -> str:
-    base = f"https://wa.me/{phone_digits}"
-    if message and message.strip():
-        return f"{base}?text={encode_for_whatsapp(message)}"
-    return base
+_BATCH_SEP = "\x01"  # فاصل لا يظهر في الرسائل، ويصبح %01 بعد الترميز
+_BATCH_SEP_ENCODED = quote(_BATCH_SEP, safe="")
+
+def encode_many_for_whatsapp(texts: List[str]) -> List[str]:
+    """يرمّز كل الرسائل باستدعاء quote واحد ثم يفصلها"""
+    if not texts:
+        return []
+    blob = _BATCH_SEP.join(texts)
+    if blob.count(_BATCH_SEP) != len(texts) - 1:
+        # الفاصل موجود داخل إحدى الرسائل: نرجع للترميز رسالة برسالة
+        return [encode_for_whatsapp(t) for t in texts]
+    return quote(blob, safe="").split(_BATCH_SEP_ENCODED)
 
 # -----------------------------
 # بناء جملة الكميات
 # -----------------------------
-def build_quantity_phrase(row: pd.Series, headers: List[str]) -> str:
-    """يبني جملة الكميات والملاحظات"""
-    parts: List[str] = []
+def build_quantity_phrases(df: pd.DataFrame, headers: List[str]) -> pd.Series:
+    """يبني جملة الكميات والملاحظات لكل الصفوف دفعة واحدة (عمودًا بعمود)"""
+    sep = "، "
+    phrases = pd.Series("", index=df.index, dtype=str)
 
     # ملاحظات
-    note = row.iat[NOTES_COL_IDX] if len(row) > NOTES_COL_IDX else None
-    if pd.notna(note) and str(note).strip():
-        parts.append(str(note).strip())
+    if df.shape[1] > NOTES_COL_IDX:
+        note = df.iloc[:, NOTES_COL_IDX].str.strip()
+        phrases += (sep + note).where(note.ne(""), "")
 
     # الأصناف
-    start, end_inc = ITEMS_START_IDX, ITEMS_END_IDX_INC
-    for idx in range(start, min(end_inc, len(row)-1) + 1):
-        item_name = headers[idx] if idx < len(headers) else f"صنف {idx+1}"
-        val = row.iat[idx] if idx < len(row) else None
-        if pd.isna(val):
-            continue
-        sval = str(val).strip()
-        if not sval or sval in ("0", "0.0"):
-            continue
-        parts.append(f"\n{item_name}: {sval}")
+    start, end_inc = ITEMS_START_IDX, min(ITEMS_END_IDX_INC, df.shape[1] - 1)
+    items = df.iloc[:, start:end_inc + 1].apply(lambda s: s.str.strip())
+    filled = items.ne("") & items.ne("0") & items.ne("0.0")
+    for pos in range(items.shape[1]):
+        item_name = headers[start + pos]
+        rendered = f"{sep}\n{item_name}: " + items.iloc[:, pos]
+        phrases += rendered.where(filled.iloc[:, pos], "")
+
+    # حذف الفاصل الزائد في البداية
+    return phrases.str[len(sep):]
+
+# -----------------------------
+# معالجة الملف (مخزنة مؤقتًا بين إعادة التشغيل)
+# -----------------------------
+def build_result_df(df: pd.DataFrame) -> pd.DataFrame:
+    """يبني جدول (رقم الهاتف، الرسالة، رابط واتساب، تم) من جدول الأوردرات كما يعيده read_orders"""
+    headers: List[str] = list(df.columns)
+
+    # معالجة البيانات
+    phones = extract_first_phone_per_row(df)
+    # أول ظهور فقط لكل رقم
+    keep = phones.notna() & ~phones.duplicated(keep="first")
+    # الرسالة تحتاج أعمدة المخطط فقط (1..12)؛ البحث عن الرقم وحده يمر على كل الأعمدة
+    orders = df.iloc[:, :ITEMS_END_IDX_INC + 1][keep]
+    quantity_phrases = build_quantity_phrases(orders, headers)
+    if orders.shape[1] > TOTAL_COL_IDX:
+        totals = orders.iloc[:, TOTAL_COL_IDX].str.strip()
+    else:
+        totals = pd.Series("", index=orders.index, dtype=str)
+    msgs: List[str] = (_TPL_PREFIX + quantity_phrases + _TPL_MIDDLE + totals + _TPL_SUFFIX).tolist()
+
+    phone_digits = phones[keep].astype(str)
+    encoded = pd.Series(encode_many_for_whatsapp(msgs), index=phone_digits.index, dtype=str)
+    return pd.DataFrame({
+        "رقم الهاتف": "+" + phone_digits,
+        "الرسالة (للمعاينة)": msgs,
+        "رابط واتساب": WA_BASE_URL + phone_digits + "?text=" + encoded,
+        "تم": False,
+    }, columns=["رقم الهاتف", "الرسالة (للمعاينة)", "رابط واتساب", "تم"]).reset_index(drop=True)
+
+# عدد الملفات المرفوعة التي تبقى في الذاكرة المؤقتة (مشتركة بين كل الجلسات)
+ORDERS_CACHE_ENTRIES = 8
+
+@st.cache_data(show_spinner=False, max_entries=ORDERS_CACHE_ENTRIES)
+def read_orders(file_bytes: bytes) -> pd.DataFrame:
+    # calamine (Rust) أسرع بكثير من openpyxl؛ نرجع لـ openpyxl إن لم تكن مثبتة
+    try:
+        df = pd.read_excel(BytesIO(file_bytes), dtype=str, header=0, engine="calamine")
+    except ImportError:
+        df = pd.read_excel(BytesIO(file_bytes), dtype=str, header=0, engine="openpyxl")
+    # الخلايا الفارغة تصبح "" مرة واحدة، فكل الخلايا بعدها نصوص
+    return df.fillna("")
 
-    return "، ".join(parts)
+@st.cache_data(show_spinner=False, max_entries=ORDERS_CACHE_ENTRIES)
+def process_orders(file_bytes: bytes) -> pd.DataFrame:
+    return build_result_df(read_orders(file_bytes))
 
 # -----------------------------
 # تصدير الملف النهائي
 # -----------------------------
+# xlsxwriter أسرع في الكتابة لمرة واحدة؛ openpyxl كبديل إن لم تكن مثبتة
+EXCEL_WRITE_ENGINE = "xlsxwriter" if importlib.util.find_spec("xlsxwriter") else "openpyxl"
+
 def to_excel_two_cols(df: pd.DataFrame, make_clickable: bool = True) -> bytes:
-    out_df = df[["رقم الهاتف", "رابط واتساب", "تم"]].copy()
+    links = df["رابط واتساب"].astype(str)
     if make_clickable:
-        out_df["رابط واتساب"] = out_df["رابط واتساب"].apply(
-            lambda url: f'=HYPERLINK("{url}", "فتح واتساب")'
-        )
+        links = '=HYPERLINK("' + links + '", "فتح واتساب")'
+    out_df = pd.DataFrame({
+        "رقم الهاتف": df["رقم الهاتف"].values,
+        "رابط واتساب": links.values,
+        "تم": df["تم"].values,
+    })
+    engine_kwargs = {}
+    if EXCEL_WRITE_ENGINE == "xlsxwriter":
+        # الروابط تُكتب كنص كما هي (بدون تحويل تلقائي لـ hyperlink)
+        engine_kwargs = {"options": {"strings_to_urls": False}}
     buffer = BytesIO()
-    with pd.ExcelWriter(buffer, engine="openpyxl") as writer:
+    with pd.ExcelWriter(buffer, engine=EXCEL_WRITE_ENGINE, engine_kwargs=engine_kwargs) as writer:
         out_df.to_excel(writer, index=False, sheet_name="WhatsApp")
-    buffer.seek(0)
     return buffer.getvalue()
 
 # -----------------------------
-# واجهة المستخدم
+# تهيئة الصفحة + RTL
 # -----------------------------
-st.subheader("📤 رفع ملف الإكسل")
-file = st.file_uploader("اختر ملف .xlsx (الصف الأول يحوي العناوين/أسماء الأصناف)", type=["xlsx"])
-
-if file:
-    try:
-        df = pd.read_excel(file, dtype=str, header=0, engine="openpyxl")
-    except ImportError:
-        st.error("التطبيق يحتاج مكتبة openpyxl لقراءة ملفات Excel.")
-        st.stop()
-    except Exception as e:
-        st.error(f"تعذر قراءة الملف: {e}")
-        st.stop()
-
-    st.dataframe(df, width="stretch")
+def setup_page() -> None:
+    st.set_page_config(
+        page_title="مُولِّد روابط واتساب للأوردرات",
+        page_icon="🟢",
+        layout="wide",
+    )
 
-    # تحذير في حالة الأعمدة غير مكتملة
-    if df.shape[1] < ITEMS_END_IDX_INC + 1:
-        st.warning("الملف لا يحتوي على الأعمدة المطلوبة حتى العمود 12. تحقق من المخطط.")
+    st.markdown("""
+<style>
+html, body, [class*="css"]  { direction: rtl; text-align: right; }
+[data-testid="stMetricValue"] { direction:ltr; }
+</style>
+""", unsafe_allow_html=True)
 
-    headers: List[str] = list(df.columns)
-    rows_out = []
-    seen_phones = set()
+    st.title("🟢 مُولِّد روابط واتساب للأوردرات")
+    st.caption("حمّل ملف الإكسل، وسيتم استخراج الأرقام وبناء الكميات ودمجها في رسالة عربية جاهزة داخل رابط واتساب.")
 
-    # معالجة البيانات
-    for _, row in df.iterrows():
-        phone_digits = extract_first_phone_from_row(row)
-        if not phone_digits:
-            continue
-        phone_display = f"+{phone_digits}"
-
-        total_val = row.iat[TOTAL_COL_IDX] if len(row) > TOTAL_COL_IDX else ""
-        total_str = "" if pd.isna(total_val) else str(total_val).strip()
-        quantity_phrase = build_quantity_phrase(row, headers)
-        msg = AR_TEMPLATE_FIXED.format(quantity=quantity_phrase, total=total_str)
-        wa_link = build_wa_link(phone_digits, msg)
-
-        if phone_display in seen_phones:
-            continue
-        seen_phones.add(phone_display)
-
-        rows_out.append({
-            "رقم الهاتف": phone_display,
-            "الرسالة (للمعاينة)": msg,
-            "رابط واتساب": wa_link,
-            "تم": False,
-        })
-
-    result_df = pd.DataFrame(rows_out, columns=["رقم الهاتف", "الرسالة (للمعاينة)", "رابط واتساب", "تم"])
-    st.metric("عدد الأرقام الصالحة", len(result_df))
-
-    # ---------------------------------------
-    # واجهة الطلبات (expander لكل طلب)
-    # ---------------------------------------
-    st.divider()
-    st.subheader("📋 قائمة الطلبات")
-    st.caption("يمكنك استعراض كل طلب، الضغط على زر واتساب، أو وضع علامة (تم) بعد الإرسال.")
-
-    done_status = {}
-    if not result_df.empty and all(col in result_df.columns for col in ["رقم الهاتف", "رابط واتساب"]):
-        export_df = result_df[["رقم الهاتف", "رابط واتساب"]].copy()
-    else:
-        export_df = pd.DataFrame(columns=["رقم الهاتف", "رابط واتساب"])
+# -----------------------------
+# واجهة الطلبات (نمطان: جدول واحد قابل للتعديل أو expander لكل طلب)
+# -----------------------------
+def render_orders_editor(result_df: pd.DataFrame) -> pd.DataFrame:
+    """يعرض كل الطلبات في st.data_editor واحد ويعيد الجدول بعد تعديل عمود (تم)"""
+    return st.data_editor(
+        result_df,
+        column_config={
+            "رقم الهاتف": st.column_config.TextColumn("رقم الهاتف"),
+            "الرسالة (للمعاينة)": st.column_config.TextColumn("نص الرسالة", width="large"),
+            "رابط واتساب": st.column_config.LinkColumn("رابط واتساب", display_text="💬 فتح واتساب"),
+            "تم": st.column_config.CheckboxColumn("تم ✅", default=False),
+        },
+        disabled=["رقم الهاتف", "الرسالة (للمعاينة)", "رابط واتساب"],
+        hide_index=True,
+        width="stretch",
+        key="orders_editor",
+    )
 
-    for i, row in result_df.iterrows():
-        phone = row["رقم الهاتف"]
-        message = row["الرسالة (للمعاينة)"]
-        link = row["رابط واتساب"]
-        z=1
+def render_orders_expander(result_df: pd.DataFrame) -> pd.DataFrame:
+    """يعرض كل طلب في expander مستقل ويعيد الجدول مع حالة (تم) من الـ checkboxes"""
+    done: List[bool] = []
+    rows = result_df[["رقم الهاتف", "الرسالة (للمعاينة)", "رابط واتساب"]].itertuples(index=False, name=None)
+    for i, (phone, message, link) in enumerate(rows):
         with st.expander(f"📞 {phone} | Order #{i+1}", expanded=(i < 3)):  # أول 3 طلبات مفتوحة افتراضيًا
             cols = st.columns([3, 1])
             with cols[0]:
                 st.text_area("نص الرسالة:", value=message, height=120, key=f"msg_{i}")
             with cols[1]:
                 st.link_button("💬 فتح واتساب", link, type="primary")
-                done_status[phone] = st.checkbox("تم ✅", key=f"done_{i}")
-
-    # ---------------------------------------
-    # التصدير إلى Excel
-    # ---------------------------------------
-    st.divider()
-    st.subheader("📦 تنزيل ملف النتائج")
+                done.append(st.checkbox("تم ✅", key=f"done_{i}"))
+    return result_df.assign(**{"تم": done})
 
-    export_df = result_df[["رقم الهاتف", "رابط واتساب"]].copy()
-    export_df["تم"] = [done_status.get(row["رقم الهاتف"], False) for _, row in result_df.iterrows()]
+# -----------------------------
+# واجهة المستخدم
+# -----------------------------
+def main(ui_mode: Literal["expander", "editor"] = "editor") -> None:
+    setup_page()
+
+    st.subheader("📤 رفع ملف الإكسل")
+    file = st.file_uploader("اختر ملف .xlsx (الصف الأول يحوي العناوين/أسماء الأصناف)", type=["xlsx"])
+
+    if file:
+        file_bytes = file.getvalue()
+        try:
+            df = read_orders(file_bytes)
+        except ImportError:
+            st.error("التطبيق يحتاج مكتبة openpyxl لقراءة ملفات Excel.")
+            st.stop()
+        except Exception as e:
+            st.error(f"تعذر قراءة الملف: {e}")
+            st.stop()
+
+        st.dataframe(df, width="stretch")
+
+        # تحذير في حالة الأعمدة غير مكتملة
+        if df.shape[1] < ITEMS_END_IDX_INC + 1:
+            st.warning("الملف لا يحتوي على الأعمدة المطلوبة حتى العمود 12. تحقق من المخطط.")
+
+        result_df = process_orders(file_bytes)
+        st.metric("عدد الأرقام الصالحة", len(result_df))
+
+        # ---------------------------------------
+        # واجهة الطلبات
+        # ---------------------------------------
+        st.divider()
+        st.subheader("📋 قائمة الطلبات")
+        st.caption("يمكنك استعراض كل طلب، الضغط على رابط واتساب، أو وضع علامة (تم) بعد الإرسال.")
+
+        render_orders = render_orders_expander if ui_mode == "expander" else render_orders_editor
+        edited_df = render_orders(result_df)
+
+        # ---------------------------------------
+        # التصدير إلى Excel
+        # ---------------------------------------
+        st.divider()
+        st.subheader("📦 تنزيل ملف النتائج")
 
-    make_clickable = st.toggle("جعل الروابط قابلة للنقر داخل Excel (HYPERLINK)", value=True ,key="make_clickable_toggle")
-    excel_bytes = to_excel_two_cols(export_df, make_clickable=make_clickable)
+        export_df = result_df[["رقم الهاتف", "رابط واتساب"]].copy()
+        export_df["تم"] = edited_df["تم"].fillna(False).astype(bool).values
 
-    st.download_button(
-        label="⬇️ تنزيل ملف (رقم الهاتف، رابط واتساب، تم)",
-        data=excel_bytes,
-        file_name="whatsapp_orders.xlsx",
-        mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-    )
+        make_clickable = st.toggle("جعل الروابط قابلة للنقر داخل Excel (HYPERLINK)", value=True ,key="make_clickable_toggle")
+        excel_bytes = to_excel_two_cols(export_df, make_clickable=make_clickable)
 
-else:
-    st.info("من فضلك ارفع ملف .xlsx حسب المخطط: العمود 1 ملاحظات، العمود 4 إجمالي، الأعمدة 5..12 أصناف (أسماء الأصناف في الصف الأول).")
+        st.download_button(
+            label="⬇️ تنزيل ملف (رقم الهاتف، رابط واتساب، تم)",
+            data=excel_bytes,
+            file_name="whatsapp_orders.xlsx",
+            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+        )
 
+    else:
+        st.info("من فضلك ارفع ملف .xlsx حسب المخطط: العمود 1 ملاحظات، العمود 4 إجمالي، الأعمدة 5..12 أصناف (أسماء الأصناف في الصف الأول).")
 
+if __name__ == "__main__":
+    # streamlit run streamlit_phone_extractor_with_ready_msg.py -- --ui expander
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--ui", choices=["expander", "editor"], default="editor")
+    main(ui_mode=parser.parse_known_args()[0].ui)